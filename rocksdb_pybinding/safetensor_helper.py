@@ -2,99 +2,219 @@ import torch
 import numpy as np
 from safetensors.torch import save_file, safe_open
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+
+def _quant_fused(x, scale):
+    """mul→round→clamp→int8cast一趟完成的量化kernel"""
+    return (x * scale).round_().clamp_(-127, 127).to(torch.int8)
+
+
+try:
+    # Inductor把四个逐元素kernel融合成一个，量化的内存流量
+    # 从约4x tensor字节降到读FP16+写INT8的约2x
+    _quant_fused = torch.compile(_quant_fused, dynamic=True)
+except Exception:
+    # 老版本torch或不支持的后端上退回eager实现
+    pass
+
+
 class SafetensorHelper:
-    def __init__(self, storage_dir="./kv_cache_storage"):
+    # 缓存的safe_open句柄上限
+    _HANDLE_CACHE_SIZE = 8
+
+    def __init__(self, storage_dir="./kv_cache_storage", zero_threshold=1e-8):
         self.storage_dir = Path(storage_dir)
         self.storage_dir.mkdir(parents=True, exist_ok=True)
+        # amax低于该阈值的channel跳过量化直接存0（变长KV cache里的
+        # padding/空cache很常见），可按工作负载调整
+        self.zero_threshold = zero_threshold
+        self._handle_cache = OrderedDict()
+        self._handle_lock = threading.Lock()
+        self._io_pool = ThreadPoolExecutor(max_workers=2)
+        self._pending_writes = []
+
+    def _get_handle(self, file_path):
+        """获取缓存的safe_open句柄，LRU复用header解析和mmap
+
+        每次load都重新open要重新解析header、重建mmap；高频读取同一
+        文件时这是纯浪费。超过上限时淘汰最久未用的句柄，引用释放后
+        底层mmap随之关闭。
+        """
+        key = str(file_path)
+        with self._handle_lock:
+            handle = self._handle_cache.get(key)
+            if handle is not None:
+                self._handle_cache.move_to_end(key)
+                return handle
+            handle = safe_open(key, framework="pt", device="cpu")
+            self._handle_cache[key] = handle
+            while len(self._handle_cache) > self._HANDLE_CACHE_SIZE:
+                self._handle_cache.popitem(last=False)
+            return handle
+
+    def _drop_handle(self, file_path):
+        """使某个文件的缓存句柄失效（文件被覆盖或删除时）"""
+        with self._handle_lock:
+            self._handle_cache.pop(str(file_path), None)
+
+    def __del__(self):
+        pool = getattr(self, "_io_pool", None)
+        if pool is not None:
+            pool.shutdown(wait=True)
+        cache = getattr(self, "_handle_cache", None)
+        if cache is not None:
+            cache.clear()
+
+    def flush(self):
+        """等待所有后台写入完成；写入线程里的异常在这里抛出"""
+        pending, self._pending_writes = self._pending_writes, []
+        for future in pending:
+            future.result()
+
+
+    def _dequantize_tensor(self, quantized_tensor, inv_scale):
+        """将int8 tensor反量化到float16，乘以inv_scale而不是做除法
+
+        inv_scale形状[..., 1]，沿最后一维per-channel广播。
+        """
+        if isinstance(inv_scale, torch.Tensor):
+            inv_scale = inv_scale.to(torch.float16)
+        return quantized_tensor.to(torch.float16).mul_(inv_scale)
+
+    @staticmethod
+    def _transfer(tensor, device):
+        """把CPU tensor搬到目标设备；CPU目标时原样返回
+
+        CUDA目标走pinned memory + non_blocking拷贝，DMA传输可以和
+        后续的磁盘读取、Python侧工作重叠。
+        """
+        if device is None or device == "cpu":
+            return tensor
+        if isinstance(device, torch.device) and device.type == "cpu":
+            return tensor
+        return tensor.pin_memory().to(device, non_blocking=True)
+
+    @staticmethod
+    def _advise_sequential(file_path):
+        """提示内核将对该文件做顺序读取，触发激进的readahead预取
+
+        safetensors内部走mmap，冷读时缺页是主要开销；提前
+        posix_fadvise(SEQUENTIAL|WILLNEED)让内核预取和Python侧工作重叠。
+        非Linux平台没有posix_fadvise时静默跳过。
+        """
+        if not hasattr(os, "posix_fadvise"):
+            return
+        fd = os.open(str(file_path), os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
     
-    def _quantize_tensor(self, tensor, scale_factor=None):
-        """将float16 tensor量化到int8"""
-        if scale_factor is None:
-            # 动态计算缩放因子：使用tensor的最大绝对值
-            max_val = torch.abs(tensor).max().item()
-            if max_val == 0:
-                scale_factor = 1.0
-            else:
-                scale_factor = 127.0 / max_val
-        
-        quantized = (tensor * scale_factor).clamp(-127, 127).round().to(torch.int8)
-        return quantized, scale_factor
-    
-    def _dequantize_tensor(self, quantized_tensor, scale_factor):
-        """将int8 tensor反量化到float16"""
-        return (quantized_tensor.float() / scale_factor).to(torch.float16)
-    
-    def save_kv_caches(self, filename, kv_caches):
+    def save_kv_caches(self, filename, kv_caches, async_write=False):
         """
         保存KV caches到safetensor文件
         Args:
             filename: 文件名
             kv_caches: list of tuples [(k1, v1), (k2, v2), ...]，每个k,v都是float16 tensor
+            async_write: True时把save_file提交到后台线程，磁盘写入和
+                         下一个batch的量化计算重叠；写入的是量化后的
+                         新tensor，调用方可以随意改动源tensor，但读取
+                         该文件前要先flush()。metadata里带"future"
         Returns:
             dict: 包含文件信息的metadata
         """
         if not kv_caches:
             raise ValueError("kv_caches cannot be empty")
-        
-        # 分别处理keys和values
-        quantized_keys = []
-        quantized_values = []
-        key_scales = []
-        value_scales = []
-        
+
+        key_shape = kv_caches[0][0].shape if isinstance(kv_caches[0][0], torch.Tensor) else None
+        value_shape = kv_caches[0][1].shape if isinstance(kv_caches[0][1], torch.Tensor) else None
         for k_tensor, v_tensor in kv_caches:
-            # 确保输入是float16类型的tensor
+            # 确保输入是tensor
             if not isinstance(k_tensor, torch.Tensor) or not isinstance(v_tensor, torch.Tensor):
                 raise ValueError("Each kv_cache item must be a tuple of (torch.Tensor, torch.Tensor)")
-            
-            # 转换为float16（如果不是的话）
-            k_tensor = k_tensor.to(torch.float16)
-            v_tensor = v_tensor.to(torch.float16)
-            
-            # 量化并保存缩放因子
-            k_quantized, k_scale = self._quantize_tensor(k_tensor)
-            v_quantized, v_scale = self._quantize_tensor(v_tensor)
-            
-            quantized_keys.append(k_quantized)
-            quantized_values.append(v_quantized)
-            key_scales.append(k_scale)
-            value_scales.append(v_scale)
-        
-        # 将所有的keys和values分别concat成大tensor
-        keys_tensor = torch.stack(quantized_keys, dim=0)  # shape: [num_caches, ...key_shape]
-        values_tensor = torch.stack(quantized_values, dim=0)  # shape: [num_caches, ...value_shape]
-        
-        # 保存缩放因子
-        key_scales_tensor = torch.tensor(key_scales, dtype=torch.float32)
-        value_scales_tensor = torch.tensor(value_scales, dtype=torch.float32)
+            # 形状必须一致：copy_会把广播兼容的错误形状静默写进文件
+            if k_tensor.shape != key_shape or v_tensor.shape != value_shape:
+                raise ValueError("All kv_cache tensors must share the same key/value shapes")
+
+        # 预分配batch buffer并把每个cache直接写进对应的slice，
+        # 省掉torch.stack对已量化数据的额外一次全量拷贝
+        num_caches = len(kv_caches)
+        ks = torch.empty((num_caches, *key_shape), dtype=torch.float16)
+        vs = torch.empty((num_caches, *value_shape), dtype=torch.float16)
+        # copy_自带dtype转换，非fp16输入也只走一次内存pass，
+        # 不需要先.to(torch.float16)生成临时tensor
+        for i, (k_tensor, v_tensor) in enumerate(kv_caches):
+            ks[i].copy_(k_tensor)
+            vs[i].copy_(v_tensor)
+
+        # per-channel（最后一维）amax：每个channel用自己的动态范围量化，
+        # outlier channel不再压低整个cache的精度；keepdim让缩放因子
+        # 在量化/反量化时直接广播，不需要view
+        # amax转fp32再求倒数，fp16下1e-12会下溢、127/x会上溢
+        k_amax = ks.abs().amax(dim=-1, keepdim=True).to(torch.float32)
+        v_amax = vs.abs().amax(dim=-1, keepdim=True).to(torch.float32)
+
+        # 近零channel（padding/空cache）直接跳过量化：乘数和存储的
+        # inv_scale都置0，量化结果与反量化结果都是精确的0，省掉一次
+        # 有损round-trip；加载侧无需分支，乘0天然得0
+        k_dead = k_amax < self.zero_threshold
+        v_dead = v_amax < self.zero_threshold
+
+        # 量化乘数（127/max）只在保存时用；持久化的是它的倒数（max/127），
+        # 反量化直接乘inv_scale，把逐元素除法换成乘法
+        k_mul = (127.0 / k_amax.clamp_min(1e-12)).masked_fill_(k_dead, 0.0)
+        v_mul = (127.0 / v_amax.clamp_min(1e-12)).masked_fill_(v_dead, 0.0)
+
+        # 一次性量化所有cache（融合kernel）
+        keys_tensor = _quant_fused(ks, k_mul)
+        values_tensor = _quant_fused(vs, v_mul)
+
+        # 反量化乘数直接存fp16：和反量化目标dtype一致，scale tensor的
+        # 存储和I/O减半，加载时也不用再downcast。小到fp16下溢的scale
+        # 变成0哨兵，其误差（<1e-5）远低于量化噪声
+        key_inv_scales_tensor = k_amax.div_(127.0).masked_fill_(k_dead, 0.0).to(torch.float16)
+        value_inv_scales_tensor = v_amax.div_(127.0).masked_fill_(v_dead, 0.0).to(torch.float16)
         
-        # 保存到safetensor文件
+        # 保存到safetensor文件；覆盖写之前丢弃旧mmap句柄
         file_path = self.storage_dir / filename
+        self._drop_handle(file_path)
         tensors_dict = {
             "keys": keys_tensor,
             "values": values_tensor,
-            "key_scales": key_scales_tensor,
-            "value_scales": value_scales_tensor,
+            "key_inv_scales": key_inv_scales_tensor,
+            "value_inv_scales": value_inv_scales_tensor,
             "num_caches": torch.tensor(len(kv_caches), dtype=torch.int32)
         }
         
-        save_file(tensors_dict, str(file_path))
-        
-        return {
+        metadata = {
             "filename": filename,
             "num_caches": len(kv_caches),
             "keys_shape": list(keys_tensor.shape),
             "values_shape": list(values_tensor.shape)
         }
+
+        if async_write:
+            future = self._io_pool.submit(save_file, tensors_dict, str(file_path))
+            self._pending_writes.append(future)
+            metadata["future"] = future
+        else:
+            save_file(tensors_dict, str(file_path))
+
+        return metadata
     
-    def load_kv_caches(self, filename, offsets):
+    def load_kv_caches(self, filename, offsets, device="cpu"):
         """
         从safetensor文件加载KV caches
         Args:
             filename: 文件名
             offsets: list of int，要读取的cache索引
+            device: 结果所在设备；CUDA设备时int8数据经pinned memory
+                    异步拷贝后在GPU上反量化，传输与磁盘读取重叠
         Returns:
             list: [(k1, v1), (k2, v2), ...] 格式的反量化数据
         """
@@ -104,34 +224,62 @@ class SafetensorHelper:
         
         results = []
         
-        with safe_open(str(file_path), framework="pt", device="cpu") as f:
-            # 获取tensor slices和缩放因子
-            keys_tensor_slice = f.get_slice("keys")
-            values_tensor_slice = f.get_slice("values")
-            key_scales_tensor = f.get_tensor("key_scales")
-            value_scales_tensor = f.get_tensor("value_scales")
+        f = self._get_handle(file_path)
+
+        # 获取tensor slices和缩放因子
+        keys_tensor_slice = f.get_slice("keys")
+        values_tensor_slice = f.get_slice("values")
+        # 缩放因子本身就以fp16持久化，读出来直接可用
+        key_inv_scales_tensor = f.get_tensor("key_inv_scales")
+        value_inv_scales_tensor = f.get_tensor("value_inv_scales")
+
+        # 当要读的offsets占文件的比例较高时，逐个slice没有优势
+        # （I/O被mmap分页主导），不如一次读出整个tensor再gather，
+        # 省掉len(offsets)次FFI往返，并让readahead顺序扫过文件
+        num_caches = keys_tensor_slice.get_shape()[0]
+        if len(offsets) * 4 >= num_caches:
+            self._advise_sequential(file_path)
+            keys = f.get_tensor("keys")
+            values = f.get_tensor("values")
+            idx = torch.as_tensor(offsets, dtype=torch.long)
+            k_sel = self._transfer(keys.index_select(0, idx), device)
+            v_sel = self._transfer(values.index_select(0, idx), device)
+            k_inv_sel = self._transfer(key_inv_scales_tensor.index_select(0, idx), device)
+            v_inv_sel = self._transfer(value_inv_scales_tensor.index_select(0, idx), device)
+
+            # 整批一次性反量化，per-channel缩放因子直接广播
+            # （device为CUDA时在GPU上执行）
+            k_fp16 = k_sel.to(torch.float16).mul_(k_inv_sel)
+            v_fp16 = v_sel.to(torch.float16).mul_(v_inv_sel)
+
+            return [(k_fp16[i], v_fp16[i]) for i in range(len(offsets))]
+
+        # 稀疏读取：按offsets逐个slice
+        for offset in offsets:
+            # 读取第offset个cache（int8数据先传输，反量化在目标设备上做）
+            k_quantized = self._transfer(keys_tensor_slice[offset], device)
+            v_quantized = self._transfer(values_tensor_slice[offset], device)
+
+            # 获取对应的[heads, 1]缩放因子；保持tensor形式避免.item()
+            # 同步，并和int8数据一样搬到目标设备上参与反量化
+            k_inv_scale = self._transfer(key_inv_scales_tensor[offset], device)
+            v_inv_scale = self._transfer(value_inv_scales_tensor[offset], device)
             
-            # 按offsets读取数据
-            for offset in offsets:
-                # 读取第offset个cache
-                k_quantized = keys_tensor_slice[offset]
-                v_quantized = values_tensor_slice[offset]
-                
-                # 获取对应的缩放因子
-                k_scale = key_scales_tensor[offset].item()
-                v_scale = value_scales_tensor[offset].item()
-                
-                # 反量化
-                k_dequantized = self._dequantize_tensor(k_quantized, k_scale)
-                v_dequantized = self._dequantize_tensor(v_quantized, v_scale)
-                
-                results.append((k_dequantized, v_dequantized))
+            # 反量化
+            k_dequantized = self._dequantize_tensor(k_quantized, k_inv_scale)
+            v_dequantized = self._dequantize_tensor(v_quantized, v_inv_scale)
+            
+            results.append((k_dequantized, v_dequantized))
         
         return results
     
-    def load_kv_caches_optimized(self, filename, offsets):
+    def load_kv_caches_optimized(self, filename, offsets, gap_merge=4):
         """
         优化版本：合并连续的offsets来减少I/O操作
+
+        gap_merge: 间隙不超过该值的相邻段合并成一次读取，多读的行
+                   事后丢弃。mmap的readahead让少量大读取比多次散读
+                   便宜；0表示只合并严格连续的offsets
         """
         file_path = self.storage_dir / filename
         if not file_path.exists():
@@ -140,73 +288,81 @@ class SafetensorHelper:
         if not offsets:
             return []
             
-        # 对offsets排序并找到连续段
-        sorted_offsets = sorted(enumerate(offsets), key=lambda x: x[1])
-        
+        # 对offsets排序并用NumPy一趟diff找出所有连续段，
+        # 替代逐元素比较的纯Python while循环；间隙<=gap_merge的
+        # 相邻段并成一个读取区间
+        offsets_arr = np.asarray(offsets)
+        order = np.argsort(offsets_arr, kind="stable")
+        sorted_vals = offsets_arr[order]
+        breaks = np.flatnonzero(np.diff(sorted_vals) > gap_merge + 1) + 1
+        segments = np.split(np.arange(len(sorted_vals)), breaks)
+
         results = [None] * len(offsets)  # 保持原始顺序
+
+        # 连续段读取是顺序访问模式，提前告诉内核开readahead
+        self._advise_sequential(file_path)
+
+        f = self._get_handle(file_path)
+
+        keys_tensor_slice = f.get_slice("keys")
+        values_tensor_slice = f.get_slice("values")
+        # 缩放因子本身就以fp16持久化，读出来直接可用
+        key_inv_scales_tensor = f.get_tensor("key_inv_scales")
+        value_inv_scales_tensor = f.get_tensor("value_inv_scales")
         
-        with safe_open(str(file_path), framework="pt", device="cpu") as f:
-            keys_tensor_slice = f.get_slice("keys")
-            values_tensor_slice = f.get_slice("values")
-            key_scales_tensor = f.get_tensor("key_scales")
-            value_scales_tensor = f.get_tensor("value_scales")
-            
-            # 处理连续段
-            i = 0
-            while i < len(sorted_offsets):
-                start_idx = i
-                start_offset = sorted_offsets[i][1]
-                
-                # 找到连续段的结束
-                while (i + 1 < len(sorted_offsets) and 
-                       sorted_offsets[i + 1][1] == sorted_offsets[i][1] + 1):
-                    i += 1
+        # 逐段读取
+        for segment in segments:
+            start_offset = int(sorted_vals[segment[0]])
+            end_offset = int(sorted_vals[segment[-1]])
+
+            # 一次性读取连续段
+            if start_offset == end_offset:
+                # 单个元素
+                k_quantized = keys_tensor_slice[start_offset]
+                v_quantized = values_tensor_slice[start_offset]
                 
-                end_offset = sorted_offsets[i][1]
+                # 0维tensor直接参与广播乘法，不需要.item()同步
+                k_inv_scale = key_inv_scales_tensor[start_offset]
+                v_inv_scale = value_inv_scales_tensor[start_offset]
                 
-                # 一次性读取连续段
-                if start_offset == end_offset:
-                    # 单个元素
-                    k_quantized = keys_tensor_slice[start_offset]
-                    v_quantized = values_tensor_slice[start_offset]
-                    
-                    k_scale = key_scales_tensor[start_offset].item()
-                    v_scale = value_scales_tensor[start_offset].item()
-                    
-                    k_dequantized = self._dequantize_tensor(k_quantized, k_scale)
-                    v_dequantized = self._dequantize_tensor(v_quantized, v_scale)
-                    
-                    orig_idx = sorted_offsets[start_idx][0]
-                    results[orig_idx] = (k_dequantized, v_dequantized)
-                else:
-                    # 连续段
-                    k_quantized_batch = keys_tensor_slice[start_offset:end_offset+1]
-                    v_quantized_batch = values_tensor_slice[start_offset:end_offset+1]
-                    k_scales_batch = key_scales_tensor[start_offset:end_offset+1]
-                    v_scales_batch = value_scales_tensor[start_offset:end_offset+1]
-                    
-                    # 分别反量化每个元素（因为每个元素有不同的缩放因子）
-                    for j in range(start_idx, i + 1):
-                        batch_idx = j - start_idx
-                        orig_idx = sorted_offsets[j][0]
-                        
-                        k_quantized = k_quantized_batch[batch_idx]
-                        v_quantized = v_quantized_batch[batch_idx]
-                        k_scale = k_scales_batch[batch_idx].item()
-                        v_scale = v_scales_batch[batch_idx].item()
-                        
-                        k_dequantized = self._dequantize_tensor(k_quantized, k_scale)
-                        v_dequantized = self._dequantize_tensor(v_quantized, v_scale)
-                        
-                        results[orig_idx] = (k_dequantized, v_dequantized)
+                k_dequantized = self._dequantize_tensor(k_quantized, k_inv_scale)
+                v_dequantized = self._dequantize_tensor(v_quantized, v_inv_scale)
                 
-                i += 1
-        
+                # 重复的offsets会落在同一个单元素段里，每个都要填上
+                for orig_idx in order[segment]:
+                    results[int(orig_idx)] = (k_dequantized, v_dequantized)
+            else:
+                # 连续（或带小间隙的）段：一次读出整个区间
+                k_quantized_batch = keys_tensor_slice[start_offset:end_offset+1]
+                v_quantized_batch = values_tensor_slice[start_offset:end_offset+1]
+                k_inv_scales_batch = key_inv_scales_tensor[start_offset:end_offset+1]
+                v_inv_scales_batch = value_inv_scales_tensor[start_offset:end_offset+1]
+
+                # 不能只比长度：重复的offset会让len(segment)凑巧等于区间
+                # 跨度（如[0,2,2]），必须确认段内offsets真的逐行连续
+                if not np.array_equal(sorted_vals[segment], np.arange(start_offset, end_offset + 1)):
+                    # 区间里有不需要或重复的行，读完后按实际offsets重选
+                    rows = torch.as_tensor(sorted_vals[segment] - start_offset, dtype=torch.long)
+                    k_quantized_batch = k_quantized_batch.index_select(0, rows)
+                    v_quantized_batch = v_quantized_batch.index_select(0, rows)
+                    k_inv_scales_batch = k_inv_scales_batch.index_select(0, rows)
+                    v_inv_scales_batch = v_inv_scales_batch.index_select(0, rows)
+
+                # 整段一次性反量化：per-channel缩放因子保持tensor形式
+                # 直接广播，避免逐元素的kernel launch和.item()同步
+                k_fp16 = k_quantized_batch.to(torch.float16).mul_(k_inv_scales_batch)
+                v_fp16 = v_quantized_batch.to(torch.float16).mul_(v_inv_scales_batch)
+
+                # 纯Python循环只做结果分发，不做tensor运算
+                for batch_idx, orig_idx in enumerate(order[segment]):
+                    results[int(orig_idx)] = (k_fp16[batch_idx], v_fp16[batch_idx])
+
         return results
     
     def cleanup_file(self, filename):
         """删除safetensor文件"""
         file_path = self.storage_dir / filename
+        self._drop_handle(file_path)
         if file_path.exists():
             os.remove(file_path)
             return True
@@ -11,14 +11,18 @@ import rocksdb_binding
 from safetensor_helper import SafetensorHelper
 
 def generate_test_kv_cache(batch_size=5, key_shape=(32, 64), value_shape=(32, 64)):
-    """生成测试用的KV cache数据"""
-    kv_caches = []
-    for i in range(batch_size):
-        # 生成随机的float16数据，范围控制在[-1, 1]之间以确保量化效果
-        k = torch.randn(key_shape, dtype=torch.float16) * 0.5
-        v = torch.randn(value_shape, dtype=torch.float16) * 0.5
-        kv_caches.append((k, v))
-    return kv_caches
+    """生成测试用的KV cache数据
+
+    随机的float16数据，范围控制在[-1, 1]之间以确保量化效果；
+    一次randn调用生成整个batch，避免2*batch_size次kernel launch
+    """
+    if key_shape == value_shape:
+        all_rand = torch.randn((batch_size, 2, *key_shape), dtype=torch.float16) * 0.5
+        return [(all_rand[i, 0], all_rand[i, 1]) for i in range(batch_size)]
+
+    ks = torch.randn((batch_size, *key_shape), dtype=torch.float16) * 0.5
+    vs = torch.randn((batch_size, *value_shape), dtype=torch.float16) * 0.5
+    return [(ks[i], vs[i]) for i in range(batch_size)]
 
 def test_safetensor_helper():
     """测试SafetensorHelper的基本功能"""
@@ -42,20 +46,29 @@ def test_safetensor_helper():
         k_diff = torch.abs(orig_k - loaded_k).max().item()
         v_diff = torch.abs(orig_v - loaded_v).max().item()
         print(f"Cache {i}: key_diff={k_diff:.6f}, value_diff={v_diff:.6f}")
-        
+
         # 检查误差是否在可接受范围内
-        # 动态量化的误差应该更小，大约是原始值的1/127的精度
-        max_orig_k = torch.abs(orig_k).max().item()
-        max_orig_v = torch.abs(orig_v).max().item()
-        
-        k_tolerance = max(max_orig_k / 127.0, 1e-4)  # 至少1e-4的容差
-        v_tolerance = max(max_orig_v / 127.0, 1e-4)
-        
-        assert k_diff < k_tolerance, f"Key difference too large: {k_diff} > {k_tolerance}"
-        assert v_diff < v_tolerance, f"Value difference too large: {v_diff} > {v_tolerance}"
-    
+        # per-channel量化的误差约为每个channel最大值的1/127，比per-tensor更紧
+        k_tolerance = torch.clamp(torch.abs(orig_k).amax(dim=-1, keepdim=True) / 127.0, min=1e-4)
+        v_tolerance = torch.clamp(torch.abs(orig_v).amax(dim=-1, keepdim=True) / 127.0, min=1e-4)
+
+        assert torch.all(torch.abs(orig_k - loaded_k) <= k_tolerance), f"Key difference too large: {k_diff}"
+        assert torch.all(torch.abs(orig_v - loaded_v) <= v_tolerance), f"Value difference too large: {v_diff}"
+    
+    # 回归：重复+gap合并的offsets下load_kv_caches_optimized要按请求的
+    # offset返回对应的行，而不是区间里错位的行
+    opt_offsets = [0, 2, 2]
+    opt_caches = helper.load_kv_caches_optimized("test_file.safetensors", opt_offsets)
+    assert len(opt_caches) == len(opt_offsets)
+    for offset, (loaded_k, loaded_v) in zip(opt_offsets, opt_caches):
+        orig_k, orig_v = test_caches[offset]
+        k_tolerance = torch.clamp(torch.abs(orig_k).amax(dim=-1, keepdim=True) / 127.0, min=1e-4)
+        v_tolerance = torch.clamp(torch.abs(orig_v).amax(dim=-1, keepdim=True) / 127.0, min=1e-4)
+        assert torch.all(torch.abs(orig_k - loaded_k) <= k_tolerance), f"Wrong key row for offset {offset}"
+        assert torch.all(torch.abs(orig_v - loaded_v) <= v_tolerance), f"Wrong value row for offset {offset}"
+
     print("SafetensorHelper test passed!")
-    
+
     # 清理
     helper.cleanup_file("test_file.safetensors")
 